@@ -1,197 +1,568 @@
 import os
 import torch
+from hashlib import blake2b
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
+from torch.utils.data import Dataset, DataLoader, Subset
 from PIL import Image, UnidentifiedImageError
 from dotenv import load_dotenv
 from huggingface_hub import login
-from transformers import MllamaForConditionalGeneration, AutoProcessor, AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from transformers import MllamaForConditionalGeneration, AutoProcessor, AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, TorchAoConfig, DynamicCache, StaticCache
 
-def get_model(token_or_env, vision=True):
+COMPILE_PAD_MULTIPLE = 64 # compiled models see padded lengths in buckets of this size, so recompiles stay rare
+CAPTION_SENTINEL = "§§CAP§§" # stands in for the caption when the chat template is tokenized ahead of time
+CHECK_CAPTIONS = ("A dog.", "Is this a cat?", "Two birds!", 'A sign that says "open".', "Sunset, 2019...", " A cat on a sofa ") # punctuation merges with the text after a caption most easily, and edge whitespace may be trimmed
+QUANTIZED_TEXT_MODELS = { # pre-quantized int4 checkpoints of Llama 3.1, there are none for Llama 3.2 vision
+    "awq": "hugging-quants/Meta-Llama-3.1-8B-Instruct-AWQ-INT4",
+    "gptq": "hugging-quants/Meta-Llama-3.1-8B-Instruct-GPTQ-INT4",
+}
+
+def get_model(token_or_env, vision=True, compile_model=False, quant=None):
+    """
+    Load the model and processor, along with the token ids of "1" and "0". quant can be None (bf16), "int8", "fp8", or for the text model "awq"/"gptq"
+    """
     hf_token = token_or_env
     if(hf_token[-4:] == ".env"):
         load_dotenv(hf_token)
         hf_token = os.getenv("HF_TOKEN") 
     login(hf_token)
 
+    # quantization has a large negative effect on perceived classification accuracy, so it is opt-in
+    if quant == "int8":
+        quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+    elif quant == "fp8": # fp8 weights and per-token fp8 activations, so matmuls run on the fp8 tensor cores of Ada/Hopper GPUs
+        quantization_config = TorchAoConfig("float8_dynamic_activation_float8_weight")
+    else:
+        quantization_config = None # awq/gptq checkpoints already contain their quantization config
+
     if vision: # vision
+        if quant in QUANTIZED_TEXT_MODELS:
+            raise ValueError(f"Quantization {quant} is only available for the text-only model.")
         MODEL_ID = "meta-llama/Llama-3.2-11B-Vision-Instruct"
         processor = AutoProcessor.from_pretrained(MODEL_ID)
-        model = MllamaForConditionalGeneration.from_pretrained(
+        model = _from_pretrained(
+            MllamaForConditionalGeneration,
             MODEL_ID,
+            compile_model=compile_model,
             torch_dtype=torch.bfloat16,
             device_map="auto",
+            quantization_config=quantization_config,
         )
+        tokenizer = processor.tokenizer
     else: # text-only
-        MODEL_ID = "meta-llama/Llama-3.1-8B-Instruct"
+        MODEL_ID = QUANTIZED_TEXT_MODELS.get(quant, "meta-llama/Llama-3.1-8B-Instruct")
         processor = AutoTokenizer.from_pretrained(MODEL_ID)
-        model = AutoModelForCausalLM.from_pretrained(
+        model = _from_pretrained(
+            AutoModelForCausalLM,
             MODEL_ID,
-            torch_dtype=torch.bfloat16,
+            compile_model=compile_model,
+            torch_dtype=torch.float16 if quant in QUANTIZED_TEXT_MODELS else torch.bfloat16, # int4 kernels use fp16 activations
             device_map="auto",
+            quantization_config=quantization_config,
         )
+        tokenizer = processor
 
-    # quantization has a large negative effect on perceived classification accuracy
-    # BNB_CONFIG = BitsAndBytesConfig(load_in_8bit=True)
-    # model = AutoModelForCausalLM.from_pretrained(
-    #     MODEL_ID,
-    #     quantization_config=BNB_CONFIG,
-    #     device_map="auto",
-    #     trust_remote_code=True,
-    # )
+    # batched samples are left padded so the last position of every row is a real token
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    true_token_id = tokenizer("1", add_special_tokens=False).input_ids[-1]
+    false_token_id = tokenizer("0", add_special_tokens=False).input_ids[-1]
 
-    return model, processor
+    if compile_model:
+        # cuda graphs need static shapes, so the kv cache is preallocated when the model supports it (Mllama does not).
+        # the filters warm up the compiled model, since they know the batch shapes
+        if model._supports_static_cache:
+            model.generation_config.cache_implementation = "static"
+        model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False, dynamic=False)
 
-def vision_filter(model, processor, metadata, caption_column, image_column, prompt, output_path, has_header, delim="\t", threshold:int=0.5, save_every:int=None, max_steps:int=10, topk:int=None, keep_corrupted:bool=False):
+    return model, processor, true_token_id, false_token_id
+
+def _from_pretrained(model_class, model_id, compile_model=False, **kwargs):
+    """
+    Load a model with FlashAttention-2, falling back to SDPA on GPUs older than Ampere or if flash-attn is not installed.
+    Compiled models always use SDPA, FlashAttention-2 unpads masked batches with host syncs that break cuda graphs
     """
-    Filter a dataset using an MLLM
+    if not compile_model and torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8:
+        try:
+            return model_class.from_pretrained(model_id, attn_implementation="flash_attention_2", **kwargs)
+        except (ImportError, ValueError) as e:
+            print(f"FlashAttention-2 is unavailable, falling back to SDPA: {e}")
+    return model_class.from_pretrained(model_id, attn_implementation="sdpa", **kwargs)
+
+def _warmup(model, processor, template, caption, true_token_id, false_token_id, batch_size, max_steps, vision=False, static_cache=None):
     """
-    msg = [
-        {"role": "user", "content": [
-            {"type": "image"},
-            {"type": "text", "text": None}
-        ]}
-    ]
+    Run a batch of the caption through the compiled model with the real batch size and max_steps, so the compilation cost is paid before filtering starts.
+    Decode steps are forced by classifying against a token the model never predicts. Other padded prompt lengths still compile when they first appear
+    """
+    print("Compiling model...")
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    req_logit_diff = torch.log(torch.tensor(threshold / (1 - threshold))) # required logit difference to meet confidence threshold (inverse sigmoid)
-    true_token_id = processor.tokenizer.convert_tokens_to_ids(processor.tokenizer.tokenize("1")[0])
-    false_token_id = processor.tokenizer.convert_tokens_to_ids(processor.tokenizer.tokenize("0")[0])
-    results = []
-    since_last_save = 0
-    missing_or_corrupted = 0
-    for row in tqdm(metadata.itertuples(index=False), total=len(metadata), desc="Classifying Samples"):
-        # safety saving
-        if save_every and since_last_save >= save_every:
-            filtered_metadata = metadata.iloc[:len(results)][results]
-            filtered_metadata.to_csv(output_path, sep=delim, index=False, header=has_header, encoding='utf-8')
-            print(f"Saved temporary filtered dataset to {output_path}")
-            since_last_save = 0
-        since_last_save += 1
-
-        # filtering
-        formatted_prompt = prompt.format(caption=getattr(row, caption_column)) if caption_column else prompt
-        msg[0]["content"][1]["text"] = formatted_prompt
-        input_text = processor.apply_chat_template(msg, add_generation_prompt=True)
+    req_logit_diff = torch.tensor(0.0, device=device)
+    if max_steps is not None:
+        true_token_id = false_token_id = model.get_output_embeddings().out_features - 1 # the last vocab entry is a reserved special token
+    classifier_ids = torch.tensor([[true_token_id, false_token_id]], device=device)
+    classifier_signs = torch.tensor([1.0, -1.0], device=device)
+    for _ in range(2): # cuda graphs are recorded on the second call of a shape
+        if vision:
+            input = processor([[Image.new("RGB", (560, 560))]] * batch_size, [template.text(caption)] * batch_size, add_special_tokens=False, padding=True, pad_to_multiple_of=COMPILE_PAD_MULTIPLE, return_tensors="pt").to(device)
+        else:
+            input = dict(processor.pad({"input_ids": [template(caption)] * batch_size}, padding=True, pad_to_multiple_of=COMPILE_PAD_MULTIPLE, return_tensors="pt").to(device))
+        _classify(model, input, req_logit_diff, classifier_ids, classifier_signs, max_steps=max_steps, cross_attn=vision, static_cache=static_cache, verbose=False)
+
+class PromptTemplate:
+    """
+    A chat formatted prompt, rendered and tokenized once around its captions so only the caption needs to be tokenized per sample.
+    render(caption) returns the chat formatted prompt of a caption. Splicing is checked against it on sample_captions, and falls back to
+    rendering (text) or tokenizing (input ids) every prompt in full if any differ. Without a tokenizer only text is available
+    """
+    def __init__(self, render, tokenizer=None, sample_captions=()):
+        self.render = render
+        self.tokenizer = tokenizer
+        self.template_text = render(CAPTION_SENTINEL)
+        parts = self.template_text.split(CAPTION_SENTINEL)
+        checked = (*CHECK_CAPTIONS, *sample_captions)
+        # the chat template can change the text around the caption (e.g. it trims message content)
+        self.spliced = True # verified below, text splices the caption into the template while this holds
+        if len(parts) > 1:
+            self.spliced = all(self.text(caption) == render(caption) for caption in checked)
+        if not self.spliced:
+            print("The chat template changes the text around the caption, every prompt will be rendered in full.")
+        self.exact = False
+        if tokenizer is None:
+            return
+
+        # whitespace around a caption can merge with it into one pre-token (e.g. ".\n\n" after a caption ending in "."),
+        # so trailing spaces before a caption and the newlines after it are tokenized with the caption, like in the full prompt
+        self.leads = []
+        self.trails = []
+        self.parts_ids = []
+        for i, part in enumerate(parts):
+            if i > 0:
+                whitespace = part[:len(part) - len(part.lstrip())]
+                self.trails.append(whitespace[:whitespace.rfind("\n") + 1])
+                part = part[len(self.trails[-1]):]
+            if i < len(parts) - 1:
+                stripped = part.rstrip(" ")
+                self.leads.append(part[len(stripped):])
+                part = stripped
+            self.parts_ids.append(tokenizer.encode(part, add_special_tokens=False))
+        self.exact = self.spliced # verified below, __call__ splices the parts while this holds
+        if self.leads and self.exact:
+            self.exact = all(self(caption) == tokenizer.encode(render(caption), add_special_tokens=False) for caption in checked)
+            if not self.exact:
+                print("Prompt tokens change around the caption, every prompt will be tokenized in full.")
+
+    @property
+    def prefix_ids(self):
+        """
+        Input ids before the first caption, which are the same for every sample
+        """
+        return self.parts_ids[0]
+
+    def text(self, caption=None):
+        """
+        Returns the prompt with caption inserted
+        """
+        if not self.spliced:
+            return self.render(caption)
+        return self.template_text.replace(CAPTION_SENTINEL, f"{caption}")
+
+    def suffix_ids(self, caption=None):
+        """
+        Returns the input ids from the first caption onwards, with caption inserted. Only valid if the template is exact
+        """
+        input_ids = []
+        for lead, trail, part_ids in zip(self.leads, self.trails, self.parts_ids[1:]):
+            input_ids += self.tokenizer.encode(f"{lead}{caption}{trail}", add_special_tokens=False)
+            input_ids += part_ids
+        return input_ids
+
+    def __call__(self, caption=None):
+        """
+        Returns the input ids of the prompt with caption inserted
+        """
+        if not self.exact:
+            return self.tokenizer.encode(self.text(caption), add_special_tokens=False)
+        return self.prefix_ids + self.suffix_ids(caption)
+
+class VisionDataset(Dataset):
+    """
+    Loads the images and prompts of a dataset, so DataLoader workers can prepare batches while the model is busy
+    """
+    def __init__(self, processor, image_paths, captions, template, pad_to_multiple_of=None):
+        self.processor = processor
+        self.image_paths = image_paths
+        self.captions = captions
+        self.template = template
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        """
+        Returns (image_path, input_text, image), where image is "missing" or "corrupted" if it could not be loaded
+        """
+        image_path = self.image_paths[idx]
         try:
-            with Image.open(getattr(row, image_column)) as input_image:
-                input = processor(input_image, input_text, add_special_tokens=False, truncation=True, return_tensors="pt").to(device)
+            with Image.open(image_path) as input_image:
+                input_image = input_image.copy()
         except FileNotFoundError:
-            print(f"Image {getattr(row, image_column)} is missing.")
-            missing_or_corrupted += 1
-            results.append(keep_corrupted)
-            continue
+            return image_path, None, "missing"
         except UnidentifiedImageError:
-            print(f"Image {getattr(row, image_column)} is corrupted.")
-            missing_or_corrupted += 1
-            results.append(keep_corrupted)
-            continue
+            return image_path, None, "corrupted"
+
+        input_text = self.template.text(self.captions[idx] if self.captions is not None else None)
+        return image_path, input_text, input_image
+
+    def collate(self, samples):
+        """
+        Process the loaded samples of a batch together. Returns (batch_len, positions of loaded samples, failed (position, image_path, reason) triples, processed input)
+        """
+        valid = [i for i, (_, _, image) in enumerate(samples) if not isinstance(image, str)]
+        failed = [(i, image_path, image) for i, (image_path, _, image) in enumerate(samples) if isinstance(image, str)]
+        input = None
+        if valid:
+            input = dict(self.processor([[samples[i][2]] for i in valid], [samples[i][1] for i in valid], add_special_tokens=False, padding=True, truncation=True, pad_to_multiple_of=self.pad_to_multiple_of, return_tensors="pt"))
+            for i in valid: # pixel data now lives in the tensors, free the decoded images right away
+                samples[i][2].close()
+        return len(samples), valid, failed, input
+
+def vision_filter(model, processor, true_token_id, false_token_id, metadata, caption_column, image_column, prompt, output_path, has_header, delim="\t", threshold:int=0.5, save_every:int=None, max_steps:int=10, topk:int=None, keep_corrupted:bool=False, batch_size:int=8, compiled:bool=False, num_workers:int=4):
+    """
+    Filter a dataset using an MLLM, classifying batch_size samples per forward pass. Samples with the same prompt and image are only classified once.
+    Kept samples are written to output_path as they are classified. compiled pads prompts to fixed length buckets and warms up the model first
+    """
+    if compiled and max_steps is not None:
+        raise ValueError(f"Compiling is not supported together with max_steps for image filtering. Mllama has no static kv cache, so every generation step would recompile.")
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    req_logit_diff = torch.log(torch.tensor(threshold / (1 - threshold), device=device)) # required logit difference to meet confidence threshold (inverse sigmoid)
+    classifier_ids = torch.tensor([[true_token_id, false_token_id]], device=device)
+    classifier_signs = torch.tensor([1.0, -1.0], device=device) # logit(1) - logit(0) as a weighted sum of the gathered logits
+    image_paths = metadata[image_column].to_numpy(copy=False)
+    if caption_column:
+        captions = metadata[caption_column].to_numpy(copy=False)
+        formatted_prompts = [prompt.format(caption=caption) for caption in captions]
+    else:
+        captions = None
+        formatted_prompts = [prompt] * len(metadata)
+    def render(caption):
+        msg = [
+            {"role": "user", "content": [
+                {"type": "image"},
+                {"type": "text", "text": prompt.format(caption=caption) if caption_column else prompt}
+            ]}
+        ]
+        return processor.apply_chat_template(msg, add_generation_prompt=True)
+    template = PromptTemplate(render, sample_captions=captions[:8] if caption_column else ())
+    with ThreadPoolExecutor() as pool: # stat calls wait on the filesystem (slow on network storage), so they run concurrently
+        owners = _first_occurrences(list(pool.map(_sample_key, formatted_prompts, image_paths)))
+    unique = [i for i, owner in enumerate(owners) if owner == i]
+    pad_to_multiple_of = COMPILE_PAD_MULTIPLE if compiled else None
+    dataset = VisionDataset(processor, image_paths, captions, template, pad_to_multiple_of)
+    loader = DataLoader(Subset(dataset, unique),
+                        batch_size=batch_size,
+                        collate_fn=dataset.collate,
+                        num_workers=num_workers,
+                        pin_memory=torch.cuda.is_available(),
+                        prefetch_factor=2 if num_workers else None)
+    if compiled and unique:
+        _warmup(model, processor, template, captions[unique[0]] if caption_column else None, true_token_id, false_token_id, batch_size, max_steps, vision=True)
+    results = [None] * len(metadata)
+    failed_rows = set()
+    resolved = 0 # every sample before this position has a result
+    since_last_save = 0
+    missing_or_corrupted = 0
+    with open(output_path, "w", encoding="utf-8", newline="") as output_file:
+        metadata.iloc[:0].to_csv(output_file, sep=delim, index=False, header=has_header)
+        progress = tqdm(total=len(metadata), desc="Classifying Samples")
+        for batch_start, (batch_len, valid, failed, input) in zip(range(0, len(unique), batch_size), _prefetch_to_device(loader, device)):
+            batch_rows = unique[batch_start:batch_start + batch_len]
 
-        results.append(vision_classify(model, input, req_logit_diff, true_token_id, false_token_id, max_steps=max_steps, topk=topk))
+            # samples with missing or corrupted images are resolved without the model
+            for i, image_path, reason in failed:
+                print(f"Image {image_path} is {reason}.")
+                results[batch_rows[i]] = keep_corrupted
+                failed_rows.add(batch_rows[i])
+
+            # filtering
+            if valid:
+                predictions = _classify(model, input, req_logit_diff, classifier_ids, classifier_signs, max_steps=max_steps, topk=topk, cross_attn=True)
+                for i, prediction in zip(valid, predictions):
+                    results[batch_rows[i]] = prediction
+                del input, predictions # release the batch so the next prefetched copy can reuse its memory
+
+            previously_resolved = resolved
+            resolved = _resolve_duplicates(results, owners, resolved)
+            missing_or_corrupted += sum(owners[i] in failed_rows for i in range(previously_resolved, resolved))
+            progress.update(resolved - previously_resolved)
+
+            # kept samples are appended to the output as soon as they are resolved
+            kept_metadata = metadata.iloc[previously_resolved:resolved][results[previously_resolved:resolved]]
+            kept_metadata.to_csv(output_file, sep=delim, index=False, header=False)
+
+            # safety saving
+            since_last_save += resolved - previously_resolved
+            if save_every and since_last_save >= save_every:
+                output_file.flush()
+                torch.cuda.empty_cache() # return cached blocks fragmented by varying batch shapes
+                print(f"Saved temporary filtered dataset to {output_path}")
+                since_last_save = 0
+        progress.close()
 
     return results, missing_or_corrupted
 
-def text_filter(model, tokenizer, metadata, caption_column, prompt, output_path, has_header, delim="\t", threshold:int=0.5, save_every:int=None, max_steps:int=10, topk:int=None):
+def text_filter(model, tokenizer, true_token_id, false_token_id, metadata, caption_column, prompt, output_path, has_header, delim="\t", threshold:int=0.5, save_every:int=None, max_steps:int=10, topk:int=None, batch_size:int=8, compiled:bool=False):
     """
-    Filter a dataset using an LLM
+    Filter a dataset using an LLM, classifying batch_size samples per forward pass. Samples with the same prompt are only classified once.
+    Kept samples are written to output_path as they are classified. compiled pads prompts to fixed length buckets and warms up the model first
     """
-    msg = [
-        {"role": "system", "content": "You are an AI assistant that follows the user's directions."},
-        {"role": "user", "content": None}
-    ]
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    req_logit_diff = torch.log(torch.tensor(threshold / (1 - threshold))) # required logit difference to meet confidence threshold (inverse sigmoid)
-    true_token_id = tokenizer.convert_tokens_to_ids(tokenizer.tokenize("1")[0])
-    false_token_id = tokenizer.convert_tokens_to_ids(tokenizer.tokenize("0")[0])
-    results = []
+    req_logit_diff = torch.log(torch.tensor(threshold / (1 - threshold), device=device)) # required logit difference to meet confidence threshold (inverse sigmoid)
+    classifier_ids = torch.tensor([[true_token_id, false_token_id]], device=device)
+    classifier_signs = torch.tensor([1.0, -1.0], device=device) # logit(1) - logit(0) as a weighted sum of the gathered logits
+    captions = metadata[caption_column].to_numpy(copy=False)
+    def render(caption):
+        msg = [
+            {"role": "system", "content": "You are an AI assistant that follows the user's directions."},
+            {"role": "user", "content": prompt.format(caption=caption)}
+        ]
+        return tokenizer.apply_chat_template(msg, add_generation_prompt=True, tokenize=False)
+    template = PromptTemplate(render, tokenizer, captions[:8])
+    # the chat template up to the first caption is the same for every sample, so its kv cache is computed once and shared by every batch
+    prefix_cache = None
+    if template.leads and template.exact and model.generation_config.cache_implementation != "static":
+        with torch.inference_mode(): # only the kv cache is needed, so logits are computed for the last position alone
+            prefix_cache = model(input_ids=torch.tensor([template.prefix_ids], device=device), use_cache=True, logits_to_keep=1).past_key_values.to_legacy_cache()
+    encode = template.suffix_ids if prefix_cache is not None else template
+    formatted_prompts = [prompt.format(caption=caption) for caption in captions]
+    owners = _first_occurrences([_sample_key(formatted_prompt) for formatted_prompt in formatted_prompts])
+    unique = [i for i, owner in enumerate(owners) if owner == i]
+    pad_to_multiple_of = COMPILE_PAD_MULTIPLE if compiled else None
+    # one static cache serves every batch, sized for the longest padded prompt
+    static_cache = None
+    if max_steps is not None and unique and model.generation_config.cache_implementation == "static":
+        max_len = max(len(encode(captions[row])) for row in unique)
+        if pad_to_multiple_of:
+            max_len = -(-max_len // pad_to_multiple_of) * pad_to_multiple_of
+        static_cache = StaticCache(config=model.config, max_batch_size=batch_size, max_cache_len=max_len + max_steps, device=device, dtype=model.dtype)
+    if compiled and unique:
+        _warmup(model, tokenizer, template, captions[unique[0]], true_token_id, false_token_id, batch_size, max_steps, static_cache=static_cache)
+    results = [None] * len(metadata)
+    resolved = 0 # every sample before this position has a result
     since_last_save = 0
-    for row in tqdm(metadata.itertuples(index=False), total=len(metadata), desc="Classifying Samples"):
-        # safety saving
-        if save_every and since_last_save >= save_every:
-            filtered_metadata = metadata.iloc[:len(results)][results]
-            filtered_metadata.to_csv(output_path, sep=delim, index=False, header=has_header, encoding='utf-8')
-            print(f"Saved temporary filtered dataset to {output_path}")
-            since_last_save = 0
-        since_last_save += 1
-        
-        formatted_prompt = prompt.format(caption=getattr(row, caption_column))
-        msg[1]["content"] = formatted_prompt
-        input = tokenizer.apply_chat_template(msg, add_generation_prompt=True, return_tensors="pt").to(device)
-        results.append(text_classify(model, input, req_logit_diff, true_token_id, false_token_id, max_steps=max_steps, topk=topk))
+    with open(output_path, "w", encoding="utf-8", newline="") as output_file:
+        metadata.iloc[:0].to_csv(output_file, sep=delim, index=False, header=has_header)
+        progress = tqdm(total=len(metadata), desc="Classifying Samples")
+        batches = (
+            (batch_rows, dict(tokenizer.pad({"input_ids": [encode(captions[row]) for row in batch_rows]}, padding=True, pad_to_multiple_of=pad_to_multiple_of, return_tensors="pt")))
+            for batch_rows in (unique[start:start + batch_size] for start in range(0, len(unique), batch_size))
+        )
+        for batch_rows, input in _prefetch_to_device(batches, device):
+            if prefix_cache is not None:
+                input = _with_prefix_cache(input, prefix_cache)
+            predictions = _classify(model, input, req_logit_diff, classifier_ids, classifier_signs, max_steps=max_steps, topk=topk, static_cache=static_cache)
+            for row, prediction in zip(batch_rows, predictions):
+                results[row] = prediction
+            del input, predictions # release the batch so the next prefetched copy can reuse its memory
+
+            previously_resolved = resolved
+            resolved = _resolve_duplicates(results, owners, resolved)
+            progress.update(resolved - previously_resolved)
+
+            # kept samples are appended to the output as soon as they are resolved
+            kept_metadata = metadata.iloc[previously_resolved:resolved][results[previously_resolved:resolved]]
+            kept_metadata.to_csv(output_file, sep=delim, index=False, header=False)
+
+            # safety saving
+            since_last_save += resolved - previously_resolved
+            if save_every and since_last_save >= save_every:
+                output_file.flush()
+                torch.cuda.empty_cache() # return cached blocks fragmented by varying batch shapes
+                print(f"Saved temporary filtered dataset to {output_path}")
+                since_last_save = 0
+        progress.close()
 
     return results
 
-def vision_classify(model, input, req_logit_diff, id_1, id_0, max_steps=10, topk=1)->bool:
+def _prefetch_to_device(batches, device):
+    """
+    Move the input dict (last element) of each batch to device. On CUDA a background thread prepares the next batch
+    (tokenization or image loading happens when it is drawn from batches), pins it and copies it on a side stream while the current batch is being classified
+    """
+    if device != "cuda":
+        for *batch, input in batches:
+            yield (*batch, None if input is None else {key: value.to(device) for key, value in input.items()})
+        return
+
+    batches = iter(batches)
+    copy_stream = torch.cuda.Stream()
+    def prepare():
+        batch = next(batches, None)
+        if batch is None:
+            return None
+        *batch, input = batch
+        with torch.cuda.stream(copy_stream):
+            if input is not None:
+                input = {key: (value if value.is_pinned() else value.pin_memory()).to(device, non_blocking=True) for key, value in input.items()}
+            copied = torch.cuda.Event()
+            copied.record()
+        return batch, input, copied
+
+    def ready(batch, input, copied):
+        # the compute stream waits for the copy, and the allocator must not reuse the memory until compute is done
+        torch.cuda.current_stream().wait_event(copied)
+        if input is not None:
+            for value in input.values():
+                value.record_stream(torch.cuda.current_stream())
+        return (*batch, input)
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        prefetched = pool.submit(prepare)
+        while prefetched.result() is not None:
+            # no local keeps the yielded batch, so the caller can free it while the generator is suspended
+            prepared, prefetched = [prefetched.result()], pool.submit(prepare)
+            yield ready(*prepared.pop())
+
+def _with_prefix_cache(input, prefix_cache):
+    """
+    Continue a batch of prompt suffixes from the cached prefix. Padding sits between the prefix and the suffixes,
+    so every row gets the positions it would have without padding
+    """
+    batch_size = input["input_ids"].shape[0]
+    prefix_len = prefix_cache[0][0].shape[2]
+    prefix_mask = torch.ones(batch_size, prefix_len, dtype=input["attention_mask"].dtype, device=input["attention_mask"].device)
+    attention_mask = torch.cat([prefix_mask, input["attention_mask"]], dim=1)
+    return {
+        "input_ids": input["input_ids"],
+        "attention_mask": attention_mask,
+        "position_ids": (attention_mask.cumsum(dim=1) - 1)[:, prefix_len:],
+        "past_key_values": DynamicCache.from_legacy_cache(tuple((key.expand(batch_size, -1, -1, -1), value.expand(batch_size, -1, -1, -1)) for key, value in prefix_cache)),
+    }
+
+def _sample_key(formatted_prompt, image_path=None):
+    """
+    Hashable key of a sample's model input, or None if the image can't be found (the sample is then loaded and reported as missing)
+    """
+    prompt_hash = blake2b(formatted_prompt.encode(), digest_size=16).digest()
+    if image_path is None:
+        return prompt_hash
+    try:
+        image_stat = os.stat(image_path)
+    except (OSError, TypeError, ValueError):
+        return None
+    return prompt_hash, image_path, image_stat.st_size, image_stat.st_mtime
+
+def _first_occurrences(keys):
+    """
+    Map every sample to the first sample with the same key. Samples without a key only map to themselves
+    """
+    first = {}
+    return [i if key is None else first.setdefault(key, i) for i, key in enumerate(keys)]
+
+def _resolve_duplicates(results, owners, resolved):
+    """
+    Copy results from first occurrences to their duplicates. Returns the position up to which every sample has a result
+    """
+    while resolved < len(results) and results[owners[resolved]] is not None:
+        results[resolved] = results[owners[resolved]]
+        resolved += 1
+    return resolved
+
+def _classify(model, input, req_logit_diff, classifier_ids, classifier_signs, max_steps=10, topk=1, cross_attn=False, static_cache=None, verbose=True)->list:
     """
-    Classify until the model gives a clear answer or reaches max_steps. If max_steps is reached, false classification is assumed.
-    **only works for 1 sample at a time currently**
+    Classify a batch until the model gives a clear answer for every sample or reaches max_steps. If max_steps is reached, false classification is assumed.
+    Samples that are already classified are dropped from the batch before the next step. cross_attn extends Mllama's cross_attention_mask to generated tokens.
+    static_cache is reused by every batch, so samples stay in the batch and the batch is filled up to the cache's batch size.
+    classifier_ids holds the ids of "1" and "0" (shape (1, 2)), and classifier_signs turns their gathered logits into logit(1) - logit(0).
+    verbose reports samples that reached max_steps.
     """
     device = input["input_ids"].device
-    steps = 1 if max_steps is None else max_steps
-
-    for _ in range(steps):
-        with torch.no_grad():
-            output = model(**input)
-            logits = output.logits[:, -1, :] # shape: (1, vocab_size)
-            # print(logits[:, [id_1, id_0]])
-        
-        if max_steps:
-            topk_ids = torch.topk(logits, topk, dim=-1).indices[0].tolist()
-            # print(processor.tokenizer.decode(topk_ids[0]))
-            if id_1 not in topk_ids and id_0 not in topk_ids:
-                # Not ready for classification
-                # Append the most likely token and update attention masks
-                next_token_id = topk_ids[0]
-                next_token_tensor = torch.tensor([[next_token_id]], device=device)
-                input["input_ids"] = torch.cat([input["input_ids"], next_token_tensor], dim=1)
-                next_attention_mask = torch.ones_like(next_token_tensor)
-                input["attention_mask"] = torch.cat([input["attention_mask"], next_attention_mask], dim=1)
-                next_cross_attention_mask = torch.tensor([[[[1, 1, 0, 0]]]], device=device)
-                input["cross_attention_mask"] = torch.cat([input["cross_attention_mask"], next_cross_attention_mask], dim=1)
-                "[[[[1,1,0,0]]],[[[1,1,0,0]]],...]"
-                continue
-        
-        # Making a classification
-        target_logits = logits[:, [id_1, id_0]]
-        difference = target_logits[:, 0] - target_logits[:, 1]
-        prediction = difference >= req_logit_diff
-
-        return prediction.item()
-        
-    print(f"Reached classification attempt limit of {max_steps}")
-    return True
-
-def text_classify(model, input, req_logit_diff, id_1, id_0, max_steps=10, topk=1)->bool:
-    """
-    Classify until the model gives a clear answer or reaches max_steps. If max_steps is reached, false classification is assumed.
-    **only works for 1 sample at a time currently**
-    """
-    device = input.device
-    steps = 1 if max_steps is None else max_steps
-
-    for _ in range(steps):
-        with torch.no_grad():
-            output = model(input)
-            logits = output.logits[:, -1, :] # shape: (1, vocab_size)
-            # print(logits[:, [id_1, id_0]])
-        
-        if max_steps:
-            topk_ids = torch.topk(logits, topk, dim=-1).indices[0].tolist()
-            # print(processor.tokenizer.decode(topk_ids[0]))
-            if id_1 not in topk_ids and id_0 not in topk_ids:
-                # Not ready for classification
-                # Append the most likely token and update attention masks
-                next_token_id = topk_ids[0]
-                next_token_tensor = torch.tensor([[next_token_id]], device=device)
-                input["input_ids"] = torch.cat([input["input_ids"], next_token_tensor], dim=1)
-                next_attention_mask = torch.ones_like(next_token_tensor)
-                input["attention_mask"] = torch.cat([input["attention_mask"], next_attention_mask], dim=1)
-                continue
-        
-        # Making a classification
-        target_logits = logits[:, [id_1, id_0]]
-        difference = target_logits[:, 0] - target_logits[:, 1]
-        prediction = difference >= req_logit_diff
-
-        return prediction.item()
-        
-    print(f"Reached classification attempt limit of {max_steps}")
-    return True
\ No newline at end of file
+    if max_steps is None:
+        # single forward pass, no kv cache is needed and every sample is classified right away
+        with torch.inference_mode():
+            logits = model(**input, use_cache=False).logits[:, -1, :]
+            difference = (logits.gather(1, classifier_ids.expand(logits.shape[0], 2)) * classifier_signs).sum(dim=1)
+            return (difference >= req_logit_diff).tolist()
+
+    batch_size = input["input_ids"].shape[0]
+    seq_len = input["attention_mask"].shape[1] # includes the cached prefix, if there is one
+    position_ids = input.get("position_ids") # only given when the positions differ from the cache positions
+    predictions = torch.ones(batch_size, dtype=torch.bool, device=device)
+    undecided = torch.arange(batch_size, device=device) # batch positions still waiting for a classification
+    static = static_cache is not None
+    if static:
+        # cuda graphs need fixed shapes, so a short batch is filled with copies of its last sample, whose predictions are never read
+        fill = static_cache.max_batch_size - batch_size
+        input["input_ids"] = torch.cat([input["input_ids"], input["input_ids"][-1:].expand(fill, -1)])
+        input["attention_mask"] = torch.cat([input["attention_mask"], input["attention_mask"][-1:].expand(fill, -1)])
+    # generated tokens fill the preallocated slots of the attention mask instead of concatenating a new one each step
+    attention_mask = torch.zeros(input["attention_mask"].shape[0], static_cache.max_cache_len if static else seq_len + max_steps, dtype=input["attention_mask"].dtype, device=device)
+    attention_mask[:, :seq_len] = input["attention_mask"]
+    cur_len = seq_len
+    if cross_attn:
+        cross_attention_mask = input["cross_attention_mask"][:, -1:] # new tokens attend to the same image tiles as the last prompt token
+    if static:
+        # the cache keeps its memory between batches (so captured cuda graphs stay valid), and the full attention mask is always passed
+        static_cache.reset()
+        cache_position = torch.arange(seq_len, device=device)
+        input["past_key_values"] = static_cache
+        input["attention_mask"] = attention_mask
+        input["cache_position"] = cache_position
+
+    with torch.inference_mode():
+        for _ in range(max_steps):
+            output = model(**input, use_cache=True)
+            logits = output.logits[:, -1, :] # shape: (len(undecided), vocab_size)
+            # print(logits.gather(1, classifier_ids.expand(logits.shape[0], 2)))
+            if static:
+                next_token_tensor = logits.argmax(dim=-1, keepdim=True)
+                logits = logits[undecided]
+
+            target_logits = logits.gather(1, classifier_ids.expand(logits.shape[0], 2))
+            # a classifier token is the most likely token, which covers topk=1 without sorting the vocab
+            max_logits, max_ids = logits.max(dim=-1)
+            ready = target_logits.max(dim=-1).values >= max_logits
+            if topk and topk > 1 and not ready.all():
+                topk_ids = torch.topk(logits[~ready], topk, dim=-1).indices
+                ready[~ready] = torch.isin(topk_ids, classifier_ids).any(dim=-1)
+
+            # Making a classification for the samples that are ready
+            difference = (target_logits * classifier_signs).sum(dim=1)
+            predictions[undecided[ready]] = (difference >= req_logit_diff)[ready]
+            if ready.all():
+                return predictions.tolist()
+
+            # Not ready for classification
+            # Drop classified samples and only feed the most likely token, the prefix is already in the kv cache
+            pending = ~ready
+            past_key_values = output.past_key_values
+            if not static:
+                next_token_tensor = max_ids[pending, None]
+                if ready.any():
+                    past_key_values.batch_select_indices(pending)
+                    attention_mask = attention_mask[pending]
+                    if position_ids is not None:
+                        position_ids = position_ids[pending]
+                    if cross_attn:
+                        cross_attention_mask = cross_attention_mask[pending]
+            undecided = undecided[pending]
+            attention_mask[:, cur_len] = 1
+            cur_len += 1
+            input = {
+                "input_ids": next_token_tensor,
+                "attention_mask": attention_mask if static else attention_mask[:, :cur_len],
+                "past_key_values": past_key_values,
+            }
+            if static:
+                cache_position = cache_position[-1:] + 1
+                input["cache_position"] = cache_position
+            if position_ids is not None:
+                position_ids = position_ids[:, -1:] + 1
+                input["position_ids"] = position_ids
+            if cross_attn:
+                input["cross_attention_mask"] = cross_attention_mask
+
+    if verbose:
+        print(f"Reached classification attempt limit of {max_steps} for {len(undecided)} samples")
+    return predictions.tolist()
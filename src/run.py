@@ -20,9 +20,13 @@ def get_args():
     parser.add_argument("--save_every", "-s", type=int, help="How often to save the filtered dataset. If not provided, then dataset will only be saved at the end")
     parser.add_argument("--has_header", "-hd", action="store_true", help="If your dataset has a header row that needs to be skipped")
     parser.add_argument("--keep_corrupted", "-k", action="store_true", help="Will keep samples with corrupted/missing images")
+    parser.add_argument("--batch_size", "-b", type=int, default=8, help="Number of samples classified together in a single forward pass")
+    parser.add_argument("--num_workers", "-w", type=int, default=4, help="Number of background processes loading images while the model runs. Only relevant if image_column is provided")
 
     # advanced
     parser.add_argument("--max_steps", "-m", type=int, default=None, help="Max number of classifier token generations before giving up and classifying as 'true'. If None, it will always classify on the first try")
+    parser.add_argument("--compile", "-c", action="store_true", help="Compile the model with torch.compile. Adds a one time compilation cost, but speeds up classification of large datasets. Not supported with image_column and max_steps together")
+    parser.add_argument("--quant", "-q", choices=["int8", "fp8", "awq", "gptq"], default=None, help="Load a quantized model for faster inference at some cost in accuracy. awq and gptq are only available for caption only filtering")
     parser.add_argument("--top_k", "-tk", type=int, default=1, help="A classifier token (1 or 0) must appear in the top_k predicted tokens, otherwise continue generating to get a more accurate classification. Only relevant if max_steps != None")
 
     return parser.parse_args()
@@ -34,10 +38,6 @@ def load_dataset(metadata, has_header, delim) -> pd.DataFrame:
         df.columns = [f"col_{i}" for i in range(df.shape[1])]
     return df
 
-def save_dataset(metadata, output_path, has_header, delim):
-    metadata.to_csv(output_path, sep=delim, index=False, header=has_header, encoding='utf-8')
-    print(f"Saved filtered dataset to {output_path}")
-
 def mllm_filter(args):
     # input validation
     if not os.path.exists(args.input_path):
@@ -62,6 +62,18 @@ def mllm_filter(args):
     if args.threshold >= 1 or args.threshold <= 0:
         raise ValueError(f"Threshold value of {args.threshold} is invalid. Must follow constraint: 0 < threshold < 1.")
     
+    if args.batch_size < 1:
+        raise ValueError(f"Batch size of {args.batch_size} is invalid. Must be at least 1.")
+
+    if args.num_workers < 0:
+        raise ValueError(f"Number of workers {args.num_workers} is invalid. Must be at least 0.")
+
+    if args.compile and args.image_column is not None and args.max_steps is not None:
+        raise ValueError(f"Compiling is not supported together with max_steps for image filtering. Mllama has no static kv cache, so every generation step would recompile.")
+
+    if args.image_column is not None and args.quant in ("awq", "gptq"):
+        raise ValueError(f"Quantization {args.quant} is only available for caption only filtering.")
+
     if not args.has_header and (isinstance(args.caption_column, str) or isinstance(args.image_column, str)):
         raise ValueError(f"If has_header is false, then caption_column and/or image_column must be indices, not strings.")
 
@@ -78,12 +90,14 @@ def mllm_filter(args):
 
     # filter
     vision = args.image_column != None
-    model, processor = filter.get_model(args.token_or_env, vision)
+    model, processor, true_token_id, false_token_id = filter.get_model(args.token_or_env, vision, compile_model=args.compile, quant=args.quant)
     model.eval()
     corrupted = 0
     if vision:
         results, corrupted = filter.vision_filter(model=model, 
                                         processor=processor, 
+                                        true_token_id=true_token_id,
+                                        false_token_id=false_token_id,
                                         metadata=metadata, 
                                         caption_column=args.caption_column, 
                                         image_column=args.image_column, 
@@ -95,10 +109,15 @@ def mllm_filter(args):
                                         save_every=args.save_every, 
                                         max_steps=args.max_steps, 
                                         topk=args.top_k,
-                                        keep_corrupted=args.keep_corrupted)
+                                        keep_corrupted=args.keep_corrupted,
+                                        batch_size=args.batch_size,
+                                        compiled=args.compile,
+                                        num_workers=args.num_workers)
     else:
         results = filter.text_filter(model=model,
                                 tokenizer=processor,
+                                true_token_id=true_token_id,
+                                false_token_id=false_token_id,
                                 metadata=metadata,
                                 caption_column=args.caption_column,
                                 prompt=args.prompt, 
@@ -108,9 +127,11 @@ def mllm_filter(args):
                                 threshold=args.threshold, 
                                 save_every=args.save_every, 
                                 max_steps=args.max_steps, 
-                                topk=args.top_k)
+                                topk=args.top_k,
+                                batch_size=args.batch_size,
+                                compiled=args.compile)
 
-    # print filter stats and save dataset
+    # print filter stats, the filtered dataset was already written during filtering
     filtered_dataset = metadata[results]
     if args.keep_corrupted:
         corrupted = 0
@@ -118,7 +139,7 @@ def mllm_filter(args):
     print(f"\nFiltered out {filtered_count} samples.")
     if not args.keep_corrupted and corrupted:
         print(f"Removed an additional {corrupted} samples that were missing or corrupted.")
-    save_dataset(filtered_dataset, args.output_path, args.has_header, delim)
+    print(f"Saved filtered dataset to {args.output_path}")
 
 def _str_or_int(value):
     # to allow column name or column index